@@ -5,26 +5,63 @@ insidr Debug Server
 WebSocket server that receives debugging events from remote devices
 and serves a web UI for viewing them.
 
+Devices connect to /ws/device (or /insidr), UI clients to /ws/subscriber;
+the HTTP API lives under /api. Everything is served by one aiohttp app on
+both the WebSocket and HTTP ports.
+
+The wire protocol (including the device.event envelope subscribers
+receive) is documented in EVENT_PROTOCOL.md.
+
 Usage:
-    python debug_server.py [--port 9229] [--host 0.0.0.0]
+    python debug_server.py [--ws-port 9229] [--http-port 9230] [--host 0.0.0.0]
 """
 
 import asyncio
 import json
 import logging
 from datetime import datetime
-from collections import defaultdict
-from typing import Dict, Set
-import websockets
-from aiohttp import web
+from collections import defaultdict, deque
+from typing import Deque, Dict, Optional, Set, Tuple
+import orjson
+from aiohttp import WSMsgType, web
 import argparse
 
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger('insidr')
 
+# Subscribers written per event-loop turn when broadcasting
+BROADCAST_BATCH_SIZE = 50
+
+# Recent events kept per device
+MAX_DEVICE_EVENTS = 1000
+
+# Outbound messages buffered per subscriber; past this the oldest are dropped
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# Seconds a new device connection has to send its _auth message
+AUTH_TIMEOUT = 10.0
+
+# Approximate size of each chunk written when streaming HTTP responses
+HTTP_CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of a send_command message as serialized by the UI
+SEND_COMMAND_PREFIX = b'{"type":"device.send_command",'
+
+def json_response(data, status=200):
+    """
+    JSON response encoded with orjson. web.json_response's dumps= hook must
+    return str, which would cost an extra decode/encode of the body.
+    """
+    return web.Response(body=orjson.dumps(data), status=status, content_type='application/json')
+
 class DebugServer:
     def __init__(self, host='0.0.0.0', ws_port=9229, http_port=9230):
         self.host = host
@@ -32,74 +69,129 @@ class DebugServer:
         self.http_port = http_port
         
         # Store connections by device ID
-        self.devices: Dict[str, websockets.WebSocketServerProtocol] = {}
+        self.devices: Dict[str, web.WebSocketResponse] = {}
         
         # Store events by device ID
-        self.device_events: Dict[str, list] = defaultdict(list)
+        self.device_events: Dict[str, Deque[bytes]] = defaultdict(
+            lambda: deque(maxlen=MAX_DEVICE_EVENTS)
+        )
         
         # Store device info
         self.device_info: Dict[str, dict] = {}
+
+        # Serialized devices.list message, rebuilt when device_info changes
+        self._devices_list_cache: Optional[bytes] = None
         
         # Subscribers (UI clients)
-        self.subscribers: Set[websockets.WebSocketServerProtocol] = set()
+        self.subscribers: Set[web.WebSocketResponse] = set()
+
+        # Immutable copy of subscribers for broadcasting, rebuilt on change
+        self._subscribers_snapshot: Tuple[web.WebSocketResponse, ...] = ()
+
+        # Outbound queue per subscriber, drained by its writer task
+        self.subscriber_queues: Dict[web.WebSocketResponse, asyncio.Queue] = {}
 
-    async def handle_device(self, websocket, path):
+        # Messages dropped per subscriber because its queue was full
+        self.subscriber_drops: Dict[web.WebSocketResponse, int] = {}
+
+        # Cached ISO timestamp, refreshed at most every 100ms
+        self._now_iso = ""
+        self._now_mono = 0.0
+
+    def _now(self):
+        """
+        Current time as an ISO string, shared by events close in time
+        """
+        t = asyncio.get_running_loop().time()
+        if t - self._now_mono > 0.1:
+            self._now_mono = t
+            self._now_iso = datetime.now().isoformat()
+        return self._now_iso
+
+    async def handle_device(self, request):
         """
         Handle connection from debugging agent on device
         """
+        # No permessage-deflate: events are small and compressing per
+        # connection costs more CPU than it saves on the wire
+        websocket = web.WebSocketResponse(compress=False)
+        await websocket.prepare(request)
+
         device_id = None
         
         try:
-            logger.info(f"Device connected from {websocket.remote_address}")
+            logger.info(f"Device connected from {request.remote}")
+
+            # The first message must be _auth; after that every message is
+            # an event, so the loop below has no _auth branch or type
+            # dispatch. Each event still gets a validation parse in
+            # _wrap_event.
+            auth = await self._receive_auth(websocket)
+            if auth is None:
+                await websocket.close(code=1008, message=b'Expected _auth')
+                return websocket
+
+            device_id = auth['deviceId']
+            # Envelope head is the same for every event from this device
+            envelope_prefix = (
+                b'{"type":"device.event","deviceId":'
+                + orjson.dumps(device_id) + b',"event":'
+            )
+            self.devices[device_id] = websocket
+            self.device_info[device_id] = {
+                'deviceId': device_id,
+                'userAgent': auth.get('userAgent'),
+                'url': auth.get('url'),
+                'connectedAt': self._now(),
+                'lastSeen': self._now()
+            }
+            self._devices_list_cache = None
+            
+            logger.info(f"Device authenticated: {device_id}")
             
-            async for message in websocket:
+            # Notify subscribers
+            await self.broadcast_to_subscribers({
+                'type': 'device.connected',
+                'payload': self.device_info[device_id]
+            })
+            
+            # Bind per-event lookups once; the loop body only uses locals
+            frame_bytes = self._frame_bytes
+            wrap_event = self._wrap_event
+            append = self.device_events[device_id].append
+            info = self.device_info[device_id]
+            now_iso = self._now
+            broadcast = self.broadcast_to_subscribers
+
+            async for msg in websocket:
+                message = frame_bytes(msg)
+                if message is None:
+                    continue
+
                 try:
-                    event = json.loads(message)
-                    
-                    # Handle authentication
-                    if event.get('type') == '_auth':
-                        device_id = event['payload']['deviceId']
-                        self.devices[device_id] = websocket
-                        self.device_info[device_id] = {
-                            'deviceId': device_id,
-                            'userAgent': event['payload']['userAgent'],
-                            'url': event['payload']['url'],
-                            'connectedAt': datetime.now().isoformat(),
-                            'lastSeen': datetime.now().isoformat()
-                        }
-                        
-                        logger.info(f"Device authenticated: {device_id}")
-                        
-                        # Notify subscribers
-                        await self.broadcast_to_subscribers({
-                            'type': 'device.connected',
-                            'payload': self.device_info[device_id]
-                        })
+                    # Store event
+                    event = wrap_event(message, envelope_prefix)
+                    if event is None:
+                        logger.error(f"Invalid JSON from device: {message}")
                         continue
+
+                    # Ring buffer: oldest event falls off once full
+                    append(event)
+                    
+                    # Update last seen (the timestamp only changes every 100ms)
+                    now = now_iso()
+                    if info['lastSeen'] is not now:
+                        info['lastSeen'] = now
+                        self._devices_list_cache = None
+                    
+                    # Broadcast to subscribers
+                    await broadcast(event)
                     
-                    # Store event
-                    if device_id:
-                        event['deviceId'] = device_id
-                        self.device_events[device_id].append(event)
-                        
-                        # Keep only recent events (last 1000)
-                        if len(self.device_events[device_id]) > 1000:
-                            self.device_events[device_id] = self.device_events[device_id][-1000:]
-                        
-                        # Update last seen
-                        self.device_info[device_id]['lastSeen'] = datetime.now().isoformat()
-                        
-                        # Broadcast to subscribers
-                        await self.broadcast_to_subscribers(event)
-                        
-                except json.JSONDecodeError:
-                    logger.error(f"Invalid JSON from device: {message}")
                 except Exception as e:
                     logger.error(f"Error processing event: {e}")
                     
-        except websockets.exceptions.ConnectionClosed:
-            logger.info(f"Device disconnected: {device_id or 'unknown'}")
         finally:
+            logger.info(f"Device disconnected: {device_id or 'unknown'}")
             if device_id and device_id in self.devices:
                 del self.devices[device_id]
                 await self.broadcast_to_subscribers({
@@ -107,124 +199,311 @@ class DebugServer:
                     'payload': {'deviceId': device_id}
                 })
 
-    async def handle_subscriber(self, websocket, path):
+        return websocket
+
+    async def _receive_auth(self, websocket):
+        """
+        Read the device's _auth handshake. Returns its payload, or None if
+        the first message isn't a valid _auth or doesn't arrive in time.
+        """
+        try:
+            msg = await websocket.receive(timeout=AUTH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"No _auth from device within {AUTH_TIMEOUT}s")
+            return None
+
+        message = self._frame_bytes(msg)
+        if message is None:
+            return None
+
+        try:
+            auth = orjson.loads(message)
+        except orjson.JSONDecodeError:
+            logger.error(f"Invalid JSON from device: {message}")
+            return None
+
+        if not isinstance(auth, dict) or auth.get('type') != '_auth':
+            payload = None
+        else:
+            payload = auth.get('payload')
+
+        # deviceId keys the device tables and must be a non-empty string
+        if not isinstance(payload, dict) or not (
+            isinstance(payload.get('deviceId'), str) and payload['deviceId']
+        ):
+            logger.error(f"Expected _auth from device, got: {message[:200]}")
+            return None
+
+        return payload
+
+    @staticmethod
+    def _frame_bytes(msg):
+        """
+        Payload of a data frame as bytes, or None for control frames
+        """
+        # The agent sends JSON in binary frames, which avoids the str
+        # decode/encode a text frame would need. Binary payloads are not
+        # UTF-8 checked by aiohttp: _wrap_event's parse rejects invalid
+        # UTF-8 before anything is relayed to subscribers as text
+        if msg.type == WSMsgType.BINARY:
+            return msg.data
+        if msg.type == WSMsgType.TEXT:
+            return msg.data.encode()
+        return None
+
+    @staticmethod
+    def _wrap_event(message, envelope_prefix):
+        """
+        Wrap a raw JSON event in a device.event envelope, splicing the
+        device's bytes in untouched. Returns None if the message isn't a
+        valid JSON object.
+        """
+        # Validation parse only: the result is discarded, but it rejects
+        # malformed JSON and invalid UTF-8 before the bytes are stored or
+        # relayed to subscribers as text
+        try:
+            event = orjson.loads(message)
+        except orjson.JSONDecodeError:
+            # orjson rejects escaped lone surrogates ("\ud800"), which
+            # JSON.stringify emits for strings that split an emoji. The
+            # stdlib parser accepts those but still rejects malformed JSON
+            # and (for bytes) invalid UTF-8.
+            try:
+                event = json.loads(message)
+            except ValueError:
+                return None
+        if not isinstance(event, dict):
+            return None
+
+        body = message.strip()
+
+        # Single allocation: join sizes the result once and copies each part
+        return b''.join((envelope_prefix, body, b'}'))
+
+    async def handle_subscriber(self, request):
         """
         Handle connection from UI client
         """
-        logger.info(f"Subscriber connected from {websocket.remote_address}")
+        # No permessage-deflate: a broadcast would be compressed again
+        # for every subscriber
+        websocket = web.WebSocketResponse(compress=False)
+        await websocket.prepare(request)
+
+        logger.info(f"Subscriber connected from {request.remote}")
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscriber_queues[websocket] = queue
+        self.subscriber_drops[websocket] = 0
         self.subscribers.add(websocket)
+        self._subscribers_snapshot = tuple(self.subscribers)
+        writer = asyncio.create_task(self._subscriber_writer(websocket, queue))
         
         try:
             # Send list of connected devices
-            await websocket.send(json.dumps({
-                'type': 'devices.list',
-                'payload': list(self.device_info.values())
-            }))
+            if self._devices_list_cache is None:
+                self._devices_list_cache = orjson.dumps({
+                    'type': 'devices.list',
+                    'payload': list(self.device_info.values())
+                })
+            await websocket.send_frame(self._devices_list_cache, WSMsgType.TEXT)
             
-            async for message in websocket:
+            async for msg in websocket:
+                if msg.type not in (WSMsgType.TEXT, WSMsgType.BINARY):
+                    continue
+
+                message = msg.data
                 try:
-                    command = json.loads(message)
+                    command = orjson.loads(message)
                     
                     if command['type'] == 'device.request_events':
                         # Send all events for a device
                         device_id = command['deviceId']
-                        events = self.device_events.get(device_id, [])
-                        await websocket.send(json.dumps({
-                            'type': 'device.events',
-                            'payload': {
-                                'deviceId': device_id,
-                                'events': events
-                            }
-                        }))
+                        await websocket.send_frame(
+                            b'{"type":"device.events","payload":{"deviceId":'
+                            + orjson.dumps(device_id)
+                            + b',"events":' + self._events_json(device_id) + b'}}',
+                            WSMsgType.TEXT
+                        )
                     
                     elif command['type'] == 'device.send_command':
                         # Forward command to device
                         device_id = command['deviceId']
                         if device_id in self.devices:
-                            await self.devices[device_id].send(json.dumps({
-                                'type': 'command',
-                                'command': command['command'],
-                                'payload': command.get('payload', {})
-                            }))
+                            await self.devices[device_id].send_frame(
+                                self._command_frame(message, command),
+                                WSMsgType.TEXT
+                            )
                             
-                except json.JSONDecodeError:
+                except orjson.JSONDecodeError:
                     logger.error(f"Invalid JSON from subscriber: {message}")
                 except Exception as e:
                     logger.error(f"Error handling subscriber message: {e}")
                     
-        except websockets.exceptions.ConnectionClosed:
-            logger.info("Subscriber disconnected")
         finally:
+            dropped = self.subscriber_drops.pop(websocket, 0)
+            logger.info(f"Subscriber disconnected ({dropped} messages dropped)")
             self.subscribers.discard(websocket)
+            self._subscribers_snapshot = tuple(self.subscribers)
+            self.subscriber_queues.pop(websocket, None)
+            writer.cancel()
+
+        return websocket
+
+    @staticmethod
+    def _command_frame(message, command):
+        """
+        Build the command message for a device: the subscriber's message
+        with its type rewritten to "command". All other keys, including
+        deviceId and any extras, are passed through on both paths. When the
+        UI message starts with its type key the bytes are forwarded as-is
+        with only the type rewritten, skipping a re-encode of the payload.
+        """
+        if 'command' not in command:
+            raise ValueError("device.send_command without a command")
+
+        if isinstance(message, str):
+            message = message.encode()
+
+        if 'payload' in command and message.startswith(SEND_COMMAND_PREFIX):
+            return b'{"type":"command",' + message[len(SEND_COMMAND_PREFIX):]
+
+        return orjson.dumps({
+            **command,
+            'type': 'command',
+            'payload': command.get('payload', {})
+        })
+
+    async def _subscriber_writer(self, websocket, queue):
+        """
+        Drain a subscriber's outbound queue onto its connection
+        """
+        try:
+            while True:
+                message = await queue.get()
+                await websocket.send_frame(message, WSMsgType.TEXT)
+        except ConnectionResetError:
+            pass
+
+    def _events_json(self, device_id):
+        """
+        JSON array of a device's stored events, joined from their raw bytes
+        """
+        return b'[' + b','.join(self.device_events.get(device_id, ())) + b']'
 
     async def broadcast_to_subscribers(self, event):
         """
         Broadcast event to all UI subscribers
         """
-        if not self.subscribers:
+        # The snapshot is replaced, never mutated, so it stays valid across
+        # the awaits below
+        subscribers = self._subscribers_snapshot
+        if not subscribers:
             return
-            
-        message = json.dumps(event)
-        disconnected = set()
-        
-        for subscriber in self.subscribers:
-            try:
-                await subscriber.send(message)
-            except websockets.exceptions.ConnectionClosed:
-                disconnected.add(subscriber)
-        
-        # Remove disconnected subscribers
-        self.subscribers -= disconnected
 
-    async def http_handler(self, request):
+        # Device events arrive pre-serialized; only control messages
+        # need encoding here
+        message = event if isinstance(event, bytes) else orjson.dumps(event)
+
+        # Hand the message to each subscriber's writer task so device
+        # ingest never waits on subscriber I/O
+        if len(subscribers) <= BROADCAST_BATCH_SIZE:
+            self._enqueue(subscribers, message)
+            return
+
+        # Large fanout: enqueue in batches and yield to the loop in between
+        # so device reads aren't starved by a single broadcast
+        for i in range(0, len(subscribers), BROADCAST_BATCH_SIZE):
+            self._enqueue(subscribers[i:i + BROADCAST_BATCH_SIZE], message)
+            await asyncio.sleep(0)
+
+    def _enqueue(self, subscribers, message):
         """
-        Serve HTTP API
+        Queue a message for delivery, dropping the oldest queued message
+        for subscribers that fell behind
         """
-        if request.path == '/api/devices':
-            return web.json_response(list(self.device_info.values()))
-        
-        elif request.path.startswith('/api/device/'):
-            device_id = request.path.split('/')[-1]
-            
-            if device_id in self.device_info:
-                return web.json_response({
-                    'info': self.device_info[device_id],
-                    'events': self.device_events.get(device_id, [])
-                })
-            else:
-                return web.json_response({'error': 'Device not found'}, status=404)
-        
-        return web.json_response({'error': 'Not found'}, status=404)
+        for subscriber in subscribers:
+            queue = self.subscriber_queues.get(subscriber)
+            if queue is None:
+                # Went away while a batched broadcast was yielding
+                continue
+            if queue.full():
+                queue.get_nowait()
+                self.subscriber_drops[subscriber] += 1
+            queue.put_nowait(message)
+
+    async def list_devices(self, request):
+        """
+        GET /api/devices
+        """
+        return json_response(list(self.device_info.values()))
+
+    async def get_device(self, request):
+        """
+        GET /api/device/{device_id}
+        """
+        device_id = request.match_info['device_id']
+
+        if device_id not in self.device_info:
+            return json_response({'error': 'Device not found'}, status=404)
+
+        # Snapshot the ring buffer: it keeps changing while writes are awaited
+        events = tuple(self.device_events.get(device_id, ()))
+
+        # Stream the stored event bytes in chunks rather than building the
+        # whole (possibly MB-sized) body in memory first
+        response = web.StreamResponse()
+        response.content_type = 'application/json'
+        await response.prepare(request)
+
+        parts = [b'{"info":', orjson.dumps(self.device_info[device_id]), b',"events":[']
+        size = 0
+        for i, event in enumerate(events):
+            if i:
+                parts.append(b',')
+            parts.append(event)
+            size += len(event)
+            if size >= HTTP_CHUNK_SIZE:
+                await response.write(b''.join(parts))
+                parts.clear()
+                size = 0
+
+        parts.append(b']}')
+        await response.write(b''.join(parts))
+        await response.write_eof()
+        return response
+
+    def create_app(self):
+        """
+        Build the aiohttp application serving WebSockets and HTTP API
+        """
+        app = web.Application()
+
+        # WebSockets for devices (/insidr is the agent's default path)
+        app.router.add_get('/ws/device', self.handle_device)
+        app.router.add_get('/insidr', self.handle_device)
+
+        # WebSocket for subscribers (UI)
+        app.router.add_get('/ws/subscriber', self.handle_subscriber)
+
+        # HTTP API
+        app.router.add_get('/api/devices', self.list_devices)
+        app.router.add_get('/api/device/{device_id}', self.get_device)
+
+        return app
 
     async def start(self):
         """
         Start WebSocket servers and HTTP API
         """
-        # WebSocket server for devices
-        device_server = await websockets.serve(
-            self.handle_device,
-            self.host,
-            self.ws_port
-        )
-        logger.info(f"Device WebSocket server listening on ws://{self.host}:{self.ws_port}")
-        
-        # WebSocket server for subscribers (UI)
-        subscriber_server = await websockets.serve(
-            self.handle_subscriber,
-            self.host,
-            self.ws_port + 1  # 9230
-        )
-        logger.info(f"Subscriber WebSocket server listening on ws://{self.host}:{self.ws_port + 1}")
-        
-        # HTTP API server
-        app = web.Application()
-        app.router.add_get('/api/devices', self.http_handler)
-        app.router.add_get('/api/device/{device_id}', self.http_handler)
-        
-        runner = web.AppRunner(app)
+        runner = web.AppRunner(self.create_app())
         await runner.setup()
-        site = web.TCPSite(runner, self.host, self.http_port)
-        await site.start()
+
+        # Same app on both ports so existing device URLs keep working
+        for port in sorted({self.ws_port, self.http_port}):
+            site = web.TCPSite(runner, self.host, port)
+            await site.start()
+
+        logger.info(f"Device WebSocket listening on ws://{self.host}:{self.ws_port}/ws/device")
+        logger.info(f"Subscriber WebSocket listening on ws://{self.host}:{self.http_port}/ws/subscriber")
         logger.info(f"HTTP API listening on http://{self.host}:{self.http_port}")
         
         # Keep running
@@ -241,6 +520,7 @@ if __name__ == '__main__':
     server = DebugServer(host=args.host, ws_port=args.ws_port, http_port=args.http_port)
     
     try:
-        asyncio.run(server.start())
+        run = uvloop.run if uvloop is not None else asyncio.run
+        run(server.start())
     except KeyboardInterrupt:
         logger.info("Server stopped")
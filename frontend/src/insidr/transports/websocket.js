@@ -23,6 +23,7 @@ class WebSocketSink {
     this.reconnectAttempts = 0;
     this.eventBuffer = [];
     this.commandHandlers = new Map();
+    this.encoder = new TextEncoder();
   }
 
   /**
@@ -99,7 +100,8 @@ class WebSocketSink {
     }
 
     try {
-      this.ws.send(JSON.stringify(event));
+      // Sent as a binary frame so the server can use the bytes as-is
+      this.ws.send(this.encoder.encode(JSON.stringify(event)));
     } catch (error) {
       console.error('[insidr] Failed to send event:', error);
     }
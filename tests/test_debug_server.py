@@ -0,0 +1,239 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import orjson
+from aiohttp.test_utils import TestClient, TestServer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+from debug_server import DebugServer  # noqa: E402
+
+
+def run(test):
+    """
+    Run an async test against a fresh DebugServer
+    """
+    async def main():
+        server = DebugServer()
+        async with TestClient(TestServer(server.create_app())) as client:
+            await test(server, client)
+
+    asyncio.run(main())
+
+
+async def connect_device(client, device_id='d1'):
+    device = await client.ws_connect('/ws/device')
+    await device.send_bytes(orjson.dumps({
+        'type': '_auth',
+        'payload': {'deviceId': device_id, 'userAgent': 'ua', 'url': 'http://x'}
+    }))
+    return device
+
+
+async def connect_subscriber(client):
+    subscriber = await client.ws_connect('/ws/subscriber')
+    message = orjson.loads(await subscriber.receive_str())
+    assert message['type'] == 'devices.list'
+    return subscriber
+
+
+def test_command_fast_path_forwards_message_with_type_rewritten():
+    async def test(server, client):
+        subscriber = await connect_subscriber(client)
+        device = await connect_device(client)
+        await subscriber.receive_str()  # device.connected
+
+        await subscriber.send_str(
+            '{"type":"device.send_command","deviceId":"d1","command":"script.execute",'
+            '"payload":{"code":"1"},"extra":true}'
+        )
+        assert await device.receive_str() == (
+            '{"type":"command","deviceId":"d1","command":"script.execute",'
+            '"payload":{"code":"1"},"extra":true}'
+        )
+
+    run(test)
+
+
+def test_command_fallback_passes_through_the_same_keys():
+    async def test(server, client):
+        subscriber = await connect_subscriber(client)
+        device = await connect_device(client)
+        await subscriber.receive_str()  # device.connected
+
+        # Not compact, so the byte-level fast path doesn't apply
+        await subscriber.send_str(
+            '{"type": "device.send_command", "deviceId": "d1", "command": "script.execute", '
+            '"payload": {"code": "1"}, "extra": true}'
+        )
+        assert orjson.loads(await device.receive_str()) == {
+            'type': 'command',
+            'deviceId': 'd1',
+            'command': 'script.execute',
+            'payload': {'code': '1'},
+            'extra': True,
+        }
+
+        # Missing payload defaults to {}
+        await subscriber.send_str(
+            '{"type":"device.send_command","deviceId":"d1","command":"agent.reload"}'
+        )
+        assert orjson.loads(await device.receive_str()) == {
+            'type': 'command',
+            'deviceId': 'd1',
+            'command': 'agent.reload',
+            'payload': {},
+        }
+
+    run(test)
+
+
+def test_auth_rejects_invalid_first_message():
+    async def test(server, client):
+        for first in (
+            b'{"type":"console","payload":{}}',
+            b'not json',
+            b'[1]',
+            b'{"type":"_auth","payload":{"deviceId":null}}',
+            b'{"type":"_auth","payload":{"deviceId":""}}',
+            b'{"type":"_auth","payload":{"deviceId":["x"]}}',
+        ):
+            device = await client.ws_connect('/ws/device')
+            await device.send_bytes(first)
+            await device.receive()
+            assert device.close_code == 1008, first
+
+        assert server.devices == {}
+        assert server.device_info == {}
+
+    run(test)
+
+
+def test_auth_times_out(monkeypatch):
+    monkeypatch.setattr('debug_server.AUTH_TIMEOUT', 0.1)
+
+    async def test(server, client):
+        device = await client.ws_connect('/ws/device')
+        await device.receive()
+        assert device.close_code == 1008
+
+    run(test)
+
+
+def test_events_are_broadcast_in_envelope():
+    async def test(server, client):
+        subscriber = await connect_subscriber(client)
+        device = await connect_device(client)
+
+        connected = orjson.loads(await subscriber.receive_str())
+        assert connected['type'] == 'device.connected'
+        assert connected['payload']['deviceId'] == 'd1'
+
+        await device.send_bytes(b'{"type":"console","payload":{"args":["hi"]}}')
+        await device.send_str('{"type":"network.request","payload":{}}')
+
+        assert orjson.loads(await subscriber.receive_str()) == {
+            'type': 'device.event',
+            'deviceId': 'd1',
+            'event': {'type': 'console', 'payload': {'args': ['hi']}},
+        }
+        assert orjson.loads(await subscriber.receive_str()) == {
+            'type': 'device.event',
+            'deviceId': 'd1',
+            'event': {'type': 'network.request', 'payload': {}},
+        }
+
+    run(test)
+
+
+def test_invalid_events_are_dropped():
+    async def test(server, client):
+        subscriber = await connect_subscriber(client)
+        device = await connect_device(client)
+        await subscriber.receive_str()  # device.connected
+
+        await device.send_bytes(b'{garbage}')
+        await device.send_bytes(b'{"type":"x","p":"\xff\xfe"}')
+        await device.send_bytes(b'[1, 2]')
+        await device.send_bytes(b'{"type":"ok"}')
+
+        # Only the valid event arrives, and the subscriber stays connected
+        message = orjson.loads(await subscriber.receive_str())
+        assert message['event'] == {'type': 'ok'}
+        assert len(server.device_events['d1']) == 1
+
+    run(test)
+
+
+def test_events_with_lone_surrogate_escapes_are_relayed():
+    async def test(server, client):
+        subscriber = await connect_subscriber(client)
+        device = await connect_device(client)
+        await subscriber.receive_str()  # device.connected
+
+        # What JSON.stringify('\u{1F600}'.slice(0, 1)) produces: half an emoji
+        await device.send_bytes(b'{"type":"console","payload":{"args":["\\ud83d"]}}')
+
+        # orjson rejects lone surrogates, so decode with the stdlib parser
+        message = json.loads(await subscriber.receive_str(timeout=5))
+        assert message['event'] == {'type': 'console', 'payload': {'args': ['\ud83d']}}
+        assert len(server.device_events['d1']) == 1
+
+    run(test)
+
+
+def test_stored_events_are_valid_json():
+    async def test(server, client):
+        subscriber = await connect_subscriber(client)
+        device = await connect_device(client)
+        await subscriber.receive_str()  # device.connected
+
+        # More than the ring holds, and enough bytes to span several chunks
+        for i in range(1200):
+            await device.send_bytes(orjson.dumps({'type': 'x', 'payload': {'i': i, 'pad': 'y' * 200}}))
+        await device.send_bytes(b'{garbage}')
+        for _ in range(1200):
+            await subscriber.receive_str()
+
+        await subscriber.send_str('{"type":"device.request_events","deviceId":"d1"}')
+        message = orjson.loads(await subscriber.receive_str())
+        assert message['type'] == 'device.events'
+        assert message['payload']['deviceId'] == 'd1'
+        events = message['payload']['events']
+        assert len(events) == 1000
+        assert events[0]['event']['payload']['i'] == 200
+        assert events[-1]['event']['payload']['i'] == 1199
+
+        response = await client.get('/api/device/d1')
+        assert response.status == 200
+        assert response.content_type == 'application/json'
+        body = orjson.loads(await response.read())
+        assert body['info']['deviceId'] == 'd1'
+        assert body['events'] == events
+
+    run(test)
+
+
+def test_http_api():
+    async def test(server, client):
+        response = await client.get('/api/device/missing')
+        assert response.status == 404
+        assert orjson.loads(await response.read()) == {'error': 'Device not found'}
+
+        subscriber = await connect_subscriber(client)
+        device = await connect_device(client)
+        await device.send_bytes(b'{"type":"ok"}')
+        await subscriber.receive_str()  # device.connected
+        await subscriber.receive_str()  # device.event
+
+        response = await client.get('/api/devices')
+        devices = orjson.loads(await response.read())
+        assert [d['deviceId'] for d in devices] == ['d1']
+
+        response = await client.get('/api/device/d1')
+        body = orjson.loads(await response.read())
+        assert body['events'] == [{'type': 'device.event', 'deviceId': 'd1', 'event': {'type': 'ok'}}]
+
+    run(test)